@@ -7,10 +7,15 @@ of the events in the dynamic events
 
 @author: gustimorth
 """
+import ijson
 import json
+import numpy as np
 import pandas as pd
 import os
+from dask import compute, delayed
+from dask.distributed import Client, LocalCluster
 from dotenv import load_dotenv
+from numba import njit
 
 # Load environment variables from .env file
 load_dotenv()
@@ -18,66 +23,279 @@ load_dotenv()
 # Get data_path from environment variable
 data_path = os.getenv("DATA_DIR", "")
 
-#Set the data path to the JSONL file. Needs to be specified from the root of all repositories
-df_matches = pd.read_parquet(f"{data_path}/matches.parquet")
 
-if not os.path.exists(f"{data_path}/freeze"):
-    os.makedirs(f"{data_path}/freeze")
+# Memory limit of every dask worker, the workers spill to disk when they go above it
+WORKER_MEMORY_LIMIT = "2GB"
 
-#match_id = df_matches['id'].values[0]
-for match_id in df_matches['id'].values:
+# Number of rows per parquet row group. Small row groups sorted by frame let readers
+# skip everything except the row groups that contain the frame they filter on
+ROW_GROUP_SIZE = 2048
+
+# Corners of the part of the pitch that is visible in the video, stored once per frame
+VISIBLE_AREA_COLUMNS = [
+    "x_top_left",
+    "y_top_left",
+    "x_bottom_left",
+    "y_bottom_left",
+    "x_bottom_right",
+    "y_bottom_right",
+    "x_top_right",
+    "y_top_right",
+]
+
+
+# Create a typed numpy array from one field of a list of dictionaries.
+# Missing values become NaN for float arrays and False for boolean arrays.
+def field_array(records, field, dtype):
+    return np.array([r.get(field) for r in records], dtype=dtype)
+
+
+# Fan out the tracking records into one row per player plus one row for the ball.
+# Compiled with numba so the loop over all players runs in native code on flat numpy arrays.
+# It runs serially, the matches are already processed in parallel by the dask workers.
+# The rows of record i start at row_offsets[i] and its players at player_offsets[i].
+@njit(cache=True)
+def expand_frames(
+    record_frames,
+    record_periods,
+    n_players,
+    player_offsets,
+    row_offsets,
+    player_ids,
+    player_detected,
+    player_x,
+    player_y,
+    ball_valid,
+    ball_detected,
+    ball_x,
+    ball_y,
+):
+    n_rows = row_offsets[-1]
+    out_record = np.empty(n_rows, dtype=np.int64)
+    out_frame = np.empty(n_rows, dtype=np.int32)
+    out_period = np.empty(n_rows, dtype=np.int8)
+    out_player_id = np.empty(n_rows, dtype=np.int32)
+    out_is_detected = np.empty(n_rows, dtype=np.bool_)
+    out_is_ball = np.empty(n_rows, dtype=np.bool_)
+    out_x = np.empty(n_rows, dtype=np.float32)
+    out_y = np.empty(n_rows, dtype=np.float32)
+
+    for i in range(len(record_frames)):
+        row = row_offsets[i]
+        for j in range(n_players[i]):
+            k = player_offsets[i] + j
+            out_record[row] = i
+            out_frame[row] = record_frames[i]
+            out_period[row] = record_periods[i]
+            out_player_id[row] = player_ids[k]
+            out_is_detected[row] = player_detected[k]
+            out_is_ball[row] = False
+            out_x[row] = player_x[k]
+            out_y[row] = player_y[k]
+            row += 1
+        # Add the ball after the players of the same frame
+        if ball_valid[i]:
+            out_record[row] = i
+            out_frame[row] = record_frames[i]
+            out_period[row] = record_periods[i]
+            out_player_id[row] = -1
+            out_is_detected[row] = ball_detected[i]
+            out_is_ball[row] = True
+            out_x[row] = ball_x[i]
+            out_y[row] = ball_y[i]
+
+    return (
+        out_record,
+        out_frame,
+        out_period,
+        out_player_id,
+        out_is_detected,
+        out_is_ball,
+        out_x,
+        out_y,
+    )
+
+
+# Get the meta data from the json file and create a dataframe with the player information
+def get_meta_data(match_id):
+    # Load the data from the json file
+    with open(f"{data_path}/meta/{match_id}.json", "r", encoding="utf-8") as f:
+        match_data = json.load(f)
+
+    pitch_length = match_data["pitch_length"]
+    pitch_width = match_data["pitch_width"]
+
+    # Create a dataframe with the team information, inlcuding the jersey colors
+    df_teams = pd.concat(
+        [
+            pd.DataFrame([match_data["away_team"]]),
+            pd.DataFrame([match_data["home_team"]]),
+        ],
+        ignore_index=True,
+    )
+    df_colors = pd.concat(
+        [
+            pd.DataFrame([match_data["away_team_kit"]]),
+            pd.DataFrame([match_data["home_team_kit"]]),
+        ],
+        ignore_index=True,
+    )
+
+    df_teams = df_teams.rename(columns={"id": "team_id", "short_name": "team_name"})
+    df_teams = df_teams.merge(df_colors, on="team_id")
+    df_teams = df_teams[["team_id", "team_name", "jersey_color", "number_color"]]
+
+    # Create dataframe with player info
+    df_players = pd.DataFrame(match_data["players"])
+    # Add team information to the player dataframe
+    df_players = df_players.rename(
+        columns={"id": "player_id", "team_id": "team_id", "number": "jersey_number"}
+    )
+    # Merge the two dataframes
+    df_players = pd.merge(df_players, df_teams, on="team_id", how="left")
+    df_players = df_players[
+        [
+            "player_id",
+            "jersey_number",
+            "short_name",
+            "team_id",
+            "team_name",
+            "jersey_color",
+            "number_color",
+        ]
+    ]
+
+    return pitch_length, pitch_width, df_players
+
+
+# Generate and save the freeze frames of a single match and return the path of the parquet file.
+# Every match has its own input and output files, so matches can be processed in parallel.
+def process_match(match_id):
     try:
         df_events = pd.read_parquet(f"{data_path}/dynamic/{match_id}.parquet")
     except:
         print(f"No dynamic events for match {match_id}")
-        continue
+        return None
     
     # Extract all end and start frames from the events
-    frames = list(set(df_events['frame_start'].to_list() + df_events['frame_end'].to_list()))
+    frames_set = set(df_events['frame_start']).union(df_events['frame_end'].tolist())
     
-    with open(f"{data_path}/tracking/{match_id}.json", 'r') as file:
-        tracking_data = json.load(file)
+    # Stream the tracking file and only keep the relevant frames, so the full
+    # tracking data of the match is never held in memory and only these frames
+    # are expanded into player rows
+    relevant = []
+    with open(f"{data_path}/tracking/{match_id}.json", 'rb') as file:
+        for d in ijson.items(file, 'item', use_float=True):
+            if d.get('frame') in frames_set and d.get('timestamp') is not None:
+                relevant.append(d)
     #
-    #tracking_demo = tracking_data[28000:29000]
+    #tracking_demo = relevant[0:1000]
     # Example of how to transform the data into a data frame for easier manipulation
     # Reading tracking data
-    custom_data = []
-    for d in tracking_data:
-        #Extract the relevant frames
-        if d.get('frame') in frames and d.get('timestamp') is not None:
-            for p in d['player_data']:
-                custom_data.append({
-                    'time': d.get('timestamp'),
-                    'frame': int(d.get('frame')),
-                    'period': d.get('period'),
-                    'player_id': p.get("player_id"),
-                    'is_detected':p.get('is_detected'),
-                    'is_ball':False,
-                    'x': p.get('x'),
-                    'y': p.get('y'),
-                    'visible_area':d.get('image_corners_projection')
-                })
-            #Add the ball
-            ball = d.get('ball_data')
-            if ball['is_detected'] is not None:
-                custom_data.append({
-                    'time': d.get('timestamp'),
-                    'frame': int(d.get('frame')),
-                    'period': d.get('period'),
-                    'player_id': -1,
-                    'is_detected':ball.get('is_detected'),
-                    'is_ball':True,
-                    'x': ball.get('x'),
-                    'y': ball.get('y'),
-                    'visible_area':d.get('image_corners_projection')
-                    }
-                )
-        
-    
-    # Transform to dataframe
-    df_frames = pd.DataFrame(custom_data)
+    # Unpack the records into flat typed numpy arrays, one entry per record or per player
+    players = [p for d in relevant for p in d['player_data']]
+    balls = [d['ball_data'] for d in relevant]
+    n_players = np.array([len(d['player_data']) for d in relevant], dtype=np.int32)
+    # Frames where the ball has no detection information get no ball row
+    ball_valid = np.array([b.get('is_detected') is not None for b in balls], dtype=bool)
+
+    # Prefix sums give the first player and the first output row of every record
+    player_offsets = np.zeros(len(relevant) + 1, dtype=np.int64)
+    np.cumsum(n_players, out=player_offsets[1:])
+    row_offsets = np.zeros(len(relevant) + 1, dtype=np.int64)
+    np.cumsum(n_players + ball_valid, out=row_offsets[1:])
+
+    (
+        row_record,
+        frame,
+        period,
+        player_id,
+        is_detected,
+        is_ball,
+        x,
+        y,
+    ) = expand_frames(
+        field_array(relevant, 'frame', np.int32),
+        field_array(relevant, 'period', np.int8),
+        n_players,
+        player_offsets,
+        row_offsets,
+        field_array(players, 'player_id', np.int32),
+        field_array(players, 'is_detected', bool),
+        field_array(players, 'x', np.float32),
+        field_array(players, 'y', np.float32),
+        ball_valid,
+        field_array(balls, 'is_detected', bool),
+        field_array(balls, 'x', np.float32),
+        field_array(balls, 'y', np.float32),
+    )
+
+    # The timestamps are strings, so they are looked up from the record of every row
+    timestamps = np.array([d.get('timestamp') for d in relevant], dtype=object)
+    df_frames = pd.DataFrame({
+        'time': timestamps[row_record],
+        'frame': frame,
+        'period': period,
+        'player_id': player_id,
+        'is_detected': is_detected,
+        'is_ball': is_ball,
+        'x': x,
+        'y': y,
+    })
+
+    # Add the player information, so the app does not need to merge it on every rerun
+    pitch_length, pitch_width, df_players = get_meta_data(match_id)
+    df_frames = df_frames.merge(df_players, on='player_id', how='left')
+    df_pitch = pd.DataFrame({
+        'match_id': [match_id],
+        'pitch_length': [pitch_length],
+        'pitch_width': [pitch_width],
+    })
+
+    # The visible area is the same for all players in a frame, so it is stored
+    # in a separate file with one row per match and frame
+    visible_areas = [d.get('image_corners_projection') or {} for d in relevant]
+    df_visible = pd.DataFrame({
+        'match_id': np.full(len(relevant), match_id, dtype=np.int64),
+        'frame': field_array(relevant, 'frame', np.int32),
+        **{column: field_array(visible_areas, column, np.float32) for column in VISIBLE_AREA_COLUMNS},
+    })
+
     print(f"Generated freeze frames for match {match_id}")
     
-    # Save as freeze frames 
-    df_frames.to_parquet(f"{data_path}/freeze/{match_id}.parquet")
+    # Save as freeze frames, sorted by frame so every row group covers a small range of frames
+    path = f"{data_path}/freeze/{match_id}.parquet"
+    df_frames = df_frames.sort_values('frame', kind='stable')
+    df_frames.to_parquet(
+        path,
+        engine='pyarrow',
+        index=False,
+        row_group_size=ROW_GROUP_SIZE,
+        compression='zstd',
+        use_dictionary=True,
+    )
+    df_visible = df_visible.sort_values('frame', kind='stable')
+    df_visible.to_parquet(
+        f"{data_path}/freeze/{match_id}_visible.parquet",
+        engine='pyarrow',
+        index=False,
+        row_group_size=ROW_GROUP_SIZE,
+        compression='zstd',
+    )
+    df_pitch.to_parquet(f"{data_path}/freeze/{match_id}_pitch.parquet")
+    return path
+
+
+if __name__ == "__main__":
+    #Set the data path to the JSONL file. Needs to be specified from the root of all repositories
+    df_matches = pd.read_parquet(f"{data_path}/matches.parquet")
+
+    if not os.path.exists(f"{data_path}/freeze"):
+        os.makedirs(f"{data_path}/freeze")
 
+    #process_match(df_matches['id'].values[0])
+    # Every match is a task in the dask graph, the scheduler spreads them over the workers
+    with LocalCluster(
+        n_workers=os.cpu_count(), threads_per_worker=1, memory_limit=WORKER_MEMORY_LIMIT
+    ) as cluster, Client(cluster):
+        compute(*[delayed(process_match)(match_id) for match_id in df_matches['id'].values])
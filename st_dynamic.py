@@ -17,7 +17,9 @@ author: @gustimorth
 
 import streamlit as st
 import pandas as pd
-import json
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from mplsoccer import Pitch
 import os
 from dotenv import load_dotenv
@@ -30,6 +32,96 @@ DATA_FOLDER = os.getenv("DATA_DIR", "")
 
 st.title("SkillCorner Dynamic Events - Passing Exploration")
 
+# Only read the columns that are used in the app, parquet files are columnar so the other columns are never decoded
+MATCH_COLUMNS = ["id", "home_team", "away_team", "date_time"]
+FREEZE_FRAME_COLUMNS = [
+    "frame",
+    "player_id",
+    "is_detected",
+    "is_ball",
+    "x",
+    "y",
+    "time",
+    "period",
+    "jersey_number",
+    "short_name",
+    "team_id",
+    "team_name",
+    "jersey_color",
+    "number_color",
+]
+# Columns of the dynamic events that are used or shown in the app, columns not present in the data are skipped
+DYNAMIC_EVENT_COLUMNS = [
+    "event_id",
+    "match_id",
+    "period",
+    "frame_start",
+    "frame_end",
+    "time_start",
+    "time_end",
+    "event_type",
+    "event_subtype",
+    "end_type",
+    "player_id",
+    "player_name",
+    "team_id",
+    "team_shortname",
+    "attacking_side",
+    "x_start",
+    "y_start",
+    "x_end",
+    "y_end",
+    "pass_outcome",
+    "player_targeted_id",
+    "player_targeted_name",
+    "player_targeted_x_pass",
+    "player_targeted_y_pass",
+    "player_targeted_x_reception",
+    "player_targeted_y_reception",
+    "associated_player_possession_event_id",
+]
+# Low cardinality string columns that are stored as categoricals to save memory and speed up comparisons
+DYNAMIC_EVENT_CATEGORY_COLUMNS = [
+    "event_type",
+    "event_subtype",
+    "end_type",
+    "attacking_side",
+    "pass_outcome",
+    "team_shortname",
+]
+FREEZE_FRAME_CATEGORY_COLUMNS = [
+    "short_name",
+    "team_name",
+    "jersey_color",
+    "number_color",
+]
+# Columns shown in the table to select a pass, fewer columns make the table faster to send to the browser
+PASS_COLUMNS = [
+    "event_id",
+    "match_id",
+    "period",
+    "time_start",
+    "player_name",
+    "team_shortname",
+    "player_targeted_name",
+    "frame_start",
+    "frame_end",
+    "pass_outcome",
+]
+# Maximum number of dynamic events shown in the dynamic events table
+EVENTS_PREVIEW_ROWS = 500
+# Coordinate columns of the dynamic events that are flipped for the team that is not attacking left to right
+COORD_COLUMNS = [
+    "x_start",
+    "x_end",
+    "player_targeted_x_pass",
+    "player_targeted_x_reception",
+    "y_start",
+    "y_end",
+    "player_targeted_y_pass",
+    "player_targeted_y_reception",
+]
+
 
 # Load the data in functions so that it is cached.
 # This means that the data is only loaded once and then stored in memory.
@@ -38,101 +130,153 @@ st.title("SkillCorner Dynamic Events - Passing Exploration")
 def get_matches():
     # Set the data path to the JSONL file. Needs to be specified from the root of all repositories
     # Create a label column from home_team and away_team (dictionaies with keys id and short_name)
-    df_matches = pd.read_parquet(f"{DATA_FOLDER}/matches.parquet")
+    df_matches = pd.read_parquet(
+        f"{DATA_FOLDER}/matches.parquet", columns=MATCH_COLUMNS
+    )
     df_matches["Match"] = (
-        df_matches["home_team"].apply(lambda x: x["short_name"])
+        df_matches["home_team"].str["short_name"]
         + " vs "
-        + df_matches["away_team"].apply(lambda x: x["short_name"])
+        + df_matches["away_team"].str["short_name"]
     )
 
     # Transform the date_time column
-    df_matches["Date"] = df_matches["date_time"].apply(lambda x: x[:10])
+    df_matches["Date"] = df_matches["date_time"].str.slice(0, 10)
     return df_matches
 
 
-# Get the dynamic data from the parquet file
+# Open several parquet files as one pyarrow dataset.
+# Pyarrow pre-buffers and coalesces the reads and reads the files in parallel.
+# The string columns in category_columns are read dictionary encoded and become categoricals in pandas.
+# The optional filters are pushed down to the parquet reader.
+def get_parquet_dataset(paths, category_columns=[], filters=None):
+    # Unify the schemas so that a column that is empty in one of the files does not break the read
+    schema = pa.unify_schemas(
+        [pq.read_schema(path) for path in paths], promote_options="permissive"
+    )
+    read_dictionary = []
+    for column in category_columns:
+        index = schema.get_field_index(column)
+        if index != -1 and pa.types.is_string(schema.field(index).type):
+            field = schema.field(index)
+            schema = schema.set(
+                index, field.with_type(pa.dictionary(pa.int32(), field.type))
+            )
+            read_dictionary.append(column)
+    return pq.ParquetDataset(
+        paths,
+        schema=schema,
+        filters=filters,
+        pre_buffer=True,
+        read_dictionary=read_dictionary,
+    )
+
+
+# Get the dynamic data from the parquet file.
+# The events are kept as a pyarrow table, so filters run as arrow compute kernels
+# and only the small filtered results are converted to pandas.
 @st.cache_data(ttl=10 * 60)
 def get_dynamic_data(match_ids=[]):
-    # Load the data from the parquet file
-    df_data = pd.DataFrame()
-    for match_id in match_ids:
-        df_events = pd.read_parquet(f"{DATA_FOLDER}/dynamic/{match_id}.parquet")
-        df_data = pd.concat([df_data, df_events], ignore_index=True)
-    return df_data
+    if len(match_ids) == 0:
+        return pa.table({})
+    # Load the data from the parquet files in one read
+    dataset = get_parquet_dataset(
+        [f"{DATA_FOLDER}/dynamic/{match_id}.parquet" for match_id in match_ids],
+        category_columns=DYNAMIC_EVENT_CATEGORY_COLUMNS,
+    )
+    columns = [
+        column for column in DYNAMIC_EVENT_COLUMNS if column in dataset.schema.names
+    ]
+    table = dataset.read(columns=columns, use_threads=True)
 
+    # We need to flip the coordinates for the events for the team that is not attacking left to right.
+    # This is done once here so that it is cached and not repeated on every rerun.
+    right_to_left = pc.fill_null(
+        pc.equal(table["attacking_side"], "right_to_left"), False
+    )
+    for column in COORD_COLUMNS:
+        if column not in table.schema.names:
+            continue
+        table = table.set_column(
+            table.schema.get_field_index(column),
+            column,
+            pc.if_else(right_to_left, pc.negate(table[column]), table[column]),
+        )
+    return table
 
-# Get the freeze frames from the parquet file
+
+# Get the pitch size of the match, which is stored in a small parquet file next to the freeze frames
 @st.cache_data(ttl=10 * 60)
-def get_freeze_frames(match_ids=[]):
-    # Load the data from the parquet file
-    df_data = pd.DataFrame()
-    for match_id in match_ids:
-        df_frames = pd.read_parquet(f"{DATA_FOLDER}/freeze/{match_id}.parquet")
-        # Add the match_id to the dataframe
-        df_frames["match_id"] = match_id
-        df_data = pd.concat([df_data, df_frames], ignore_index=True)
-    return df_data
-
-
-# Get the meta data from the json file and create a dataframe with the player information
+def get_pitch_size(match_id):
+    df_pitch = pd.read_parquet(f"{DATA_FOLDER}/freeze/{match_id}_pitch.parquet")
+    return df_pitch["pitch_length"].iloc[0], df_pitch["pitch_width"].iloc[0]
+
+
+# Get a single freeze frame, the player information is already part of the freeze frames.
+# Only the freeze frames of the match are read and the frame filter is pushed down to pyarrow,
+# so the row groups that do not contain the frame are skipped.
 @st.cache_data(ttl=10 * 60)
-def get_meta_data(match_id):
-    # Load the data from the json file
-    with open(f"{DATA_FOLDER}/meta/{match_id}.json", "r", encoding="utf-8") as f:
-        match_data = json.load(f)
-
-    pitch_length = match_data["pitch_length"]
-    pitch_width = match_data["pitch_width"]
-
-    # Create a dataframe with the team information, inlcuding the jersey colors
-    df_teams = pd.concat(
-        [
-            pd.DataFrame([match_data["away_team"]]),
-            pd.DataFrame([match_data["home_team"]]),
-        ],
-        ignore_index=True,
-    )
-    df_colors = pd.concat(
-        [
-            pd.DataFrame([match_data["away_team_kit"]]),
-            pd.DataFrame([match_data["home_team_kit"]]),
-        ],
-        ignore_index=True,
+def get_frame(match_id, frame):
+    dataset = get_parquet_dataset(
+        [f"{DATA_FOLDER}/freeze/{match_id}.parquet"],
+        category_columns=FREEZE_FRAME_CATEGORY_COLUMNS,
+        filters=[("frame", "==", frame)],
     )
+    df_frame = dataset.read(columns=FREEZE_FRAME_COLUMNS).to_pandas()
+    # Add the match_id to the dataframe
+    df_frame["match_id"] = match_id
+    return df_frame
 
-    df_teams = df_teams.rename(columns={"id": "team_id", "short_name": "team_name"})
-    df_teams = df_teams.merge(df_colors, on="team_id")
-    df_teams = df_teams[["team_id", "team_name", "jersey_color", "number_color"]]
 
-    # Create dataframe with player info
-    df_players = pd.DataFrame(match_data["players"])
-    # Add team information to the player dataframe
-    df_players = df_players.rename(
-        columns={"id": "player_id", "team_id": "team_id", "number": "jersey_number"}
+# Get the visible area of a single frame.
+# It is stored once per match and frame in a separate file, so only that one row is read.
+@st.cache_data(ttl=10 * 60)
+def get_visible_area(match_id, frame):
+    df_visible = pd.read_parquet(
+        f"{DATA_FOLDER}/freeze/{match_id}_visible.parquet",
+        filters=[("match_id", "==", match_id), ("frame", "==", frame)],
     )
-    # Merge the two dataframes
-    df_players = pd.merge(df_players, df_teams, on="team_id", how="left")
-    df_players = df_players[
-        [
-            "player_id",
-            "jersey_number",
-            "short_name",
-            "team_id",
-            "team_name",
-            "jersey_color",
-            "number_color",
-        ]
-    ]
-
-    return pitch_length, pitch_width, df_players
+    return df_visible.iloc[0]
+
+
+# Get the figure with the drawn pitch for the pitch size.
+# Drawing the pitch is slow, so it is only drawn once per session and pitch size and kept in the session state.
+# The artists that are added for a frame are tracked so they can be removed before the next frame is drawn.
+def get_pitch_figure(pitch_length, pitch_width):
+    key = f"pitch_figure_{pitch_length}_{pitch_width}"
+    if key not in st.session_state:
+        pitch = Pitch(
+            pitch_type="skillcorner",
+            pitch_width=pitch_width,
+            pitch_length=pitch_length,
+        )
+        fig, ax = pitch.draw()
+        st.session_state[key] = {
+            "fig": fig,
+            "ax": ax,
+            "pitch": pitch,
+            "subplot_params": {
+                param: getattr(fig.subplotpars, param)
+                for param in ["left", "right", "bottom", "top"]
+            },
+            "artists": [],
+        }
+    return st.session_state[key]
 
 
 # Function to plot the frame
-def plot_frame(df_frame, pitch_length, pitch_width, only_detected, df_events):
-    pitch = Pitch(
-        pitch_type="skillcorner", pitch_width=pitch_width, pitch_length=pitch_length
-    )
-    fig, ax = pitch.draw()
+def plot_frame(
+    df_frame, visible_area, pitch_length, pitch_width, only_detected, df_events
+):
+    pitch_figure = get_pitch_figure(pitch_length, pitch_width)
+    fig, ax, pitch = pitch_figure["fig"], pitch_figure["ax"], pitch_figure["pitch"]
+
+    # Remove the artists of the previous frame, the pitch itself is kept
+    artists = pitch_figure["artists"]
+    for artist in artists:
+        artist.remove()
+    artists.clear()
+    # Reset the layout to how the pitch was drawn, so the layout is the same on every rerun
+    fig.subplots_adjust(**pitch_figure["subplot_params"])
 
     if only_detected:
         df_frame = df_frame[df_frame["is_detected"]]
@@ -141,64 +285,78 @@ def plot_frame(df_frame, pitch_length, pitch_width, only_detected, df_events):
     player_data = df_frame[df_frame["is_ball"] == False]
 
     # Plot the ball points
-    ax.scatter(ball_data["x"], ball_data["y"], s=50, color="black", zorder=6)
+    artists.append(
+        ax.scatter(ball_data["x"], ball_data["y"], s=50, color="black", zorder=6)
+    )
 
     # Plot the players
-    ax.scatter(
-        player_data["x"],
-        player_data["y"],
-        s=150,
-        color=player_data["jersey_color"],
-        edgecolor="black",
-        zorder=5,
+    artists.append(
+        ax.scatter(
+            player_data["x"],
+            player_data["y"],
+            s=150,
+            color=player_data["jersey_color"],
+            edgecolor="black",
+            zorder=5,
+        )
     )
 
     # Add jersey numbers on the players
-    for _, row in player_data.iterrows():
-        ax.text(
-            row["x"],
-            row["y"],
-            str(int(row["jersey_number"])),
-            color=row["number_color"],
-            ha="center",
-            va="center",
-            fontsize=8,
-            weight="bold",
-            zorder=6,
+    # Loop over plain numpy arrays instead of creating a pandas Series for every row
+    xs = player_data["x"].to_numpy()
+    ys = player_data["y"].to_numpy()
+    numbers = player_data["jersey_number"].astype(int).astype(str).to_numpy()
+    number_colors = player_data["number_color"].to_numpy()
+    for x, y, number, number_color in zip(xs, ys, numbers, number_colors):
+        artists.append(
+            ax.text(
+                x,
+                y,
+                number,
+                color=number_color,
+                ha="center",
+                va="center",
+                fontsize=8,
+                weight="bold",
+                zorder=6,
+            )
         )
 
     # Retrieve the game time and period from the frame data
-    df_frame["time"] = df_frame["time"].apply(
-        lambda x: str(int(x.split(":")[0]) * 60 + int(x.split(":")[1]))
-        + ":"
-        + x.split(":")[2]
-    )
+    # Convert hours:minutes:seconds to minutes:seconds, splitting the strings only once
+    time_parts = df_frame["time"].str.split(":", n=2, expand=True)
+    df_frame["time"] = (
+        time_parts[0].astype(int) * 60 + time_parts[1].astype(int)
+    ).astype(str) + ":" + time_parts[2]
     game_time = df_frame["time"].iloc[0][0:5]
     period = int(df_frame["period"].iloc[0])
 
     # Display the match label
-    ax.text(
-        0,
-        pitch_width / 2 + 12,
-        f"{df_matches[df_matches['id'] == match_id]['Match'].values[0]}",
-        ha="center",
-        va="center",
-        fontsize=15,
-        color="black",
-        fontweight="bold",
+    artists.append(
+        ax.text(
+            0,
+            pitch_width / 2 + 12,
+            f"{df_matches[df_matches['id'] == match_id]['Match'].values[0]}",
+            ha="center",
+            va="center",
+            fontsize=15,
+            color="black",
+            fontweight="bold",
+        )
     )
     # Display the game time and period on top of the pitch
-    ax.text(
-        0,
-        pitch_width / 2 + 7,
-        f"Period {period} - Time {game_time}",
-        ha="center",
-        va="center",
-        fontsize=15,
-        color="black",
+    artists.append(
+        ax.text(
+            0,
+            pitch_width / 2 + 7,
+            f"Period {period} - Time {game_time}",
+            ha="center",
+            va="center",
+            fontsize=15,
+            color="black",
+        )
     )
 
-    visible_area = df_frame.visible_area.values[0]
     # PLot the visible area
     # Extract the points in order
     polygon_points = [
@@ -208,24 +366,10 @@ def plot_frame(df_frame, pitch_length, pitch_width, only_detected, df_events):
         (visible_area["x_top_right"], visible_area["y_top_right"]),
     ]
 
-    pitch.polygon([polygon_points], color=(1, 0, 0, 0.3), ax=ax)
+    artists.extend(pitch.polygon([polygon_points], color=(1, 0, 0, 0.3), ax=ax))
 
     # Plot the events
-    # We need to flip the coordinates for the events for the team that is not attacking left to right
-    coord_columns = [
-        "x_start",
-        "x_end",
-        "player_targeted_x_pass",
-        "player_targeted_x_reception",
-        "y_start",
-        "y_end",
-        "player_targeted_y_pass",
-        "player_targeted_y_reception",
-    ]
-    df_events.loc[df_events["attacking_side"] == "right_to_left", coord_columns] = (
-        -1
-        * df_events.loc[df_events["attacking_side"] == "right_to_left", coord_columns]
-    )
+    # The coordinates are already flipped for the team that is not attacking left to right in get_dynamic_data
     # Add columns for the current x and y coordinates of the players at the moment of the event
     df_events = df_events.merge(
         df_frame[["player_id", "x", "y"]].rename(
@@ -242,75 +386,85 @@ def plot_frame(df_frame, pitch_length, pitch_width, only_detected, df_events):
 
     # Draw the pass as an arrow
     if len(df_pass) > 0:
-        pitch.arrows(
-            df_pass.x_end,
-            df_pass.y_end,
-            (
-                df_pass.player_targeted_x_reception
-                if df_pass.pass_outcome.values[0] == "successful"
-                else df_pass.player_targeted_x_pass
-            ),
-            (
-                df_pass.player_targeted_y_reception
-                if df_pass.pass_outcome.values[0] == "successful"
-                else df_pass.player_targeted_y_pass
-            ),
-            width=2,
-            headwidth=4,
-            headlength=6,
-            color="black",
-            label="Pass",
-            zorder=7,
-            ax=ax,
+        artists.append(
+            pitch.arrows(
+                df_pass.x_end,
+                df_pass.y_end,
+                (
+                    df_pass.player_targeted_x_reception
+                    if df_pass.pass_outcome.values[0] == "successful"
+                    else df_pass.player_targeted_x_pass
+                ),
+                (
+                    df_pass.player_targeted_y_reception
+                    if df_pass.pass_outcome.values[0] == "successful"
+                    else df_pass.player_targeted_y_pass
+                ),
+                width=2,
+                headwidth=4,
+                headlength=6,
+                color="black",
+                label="Pass",
+                zorder=7,
+                ax=ax,
+            )
         )
 
     # Draw the off ball run as an arrow
     if len(df_run) > 0:
-        pitch.arrows(
-            df_run.x_current_frame,
-            df_run.y_current_frame,
-            df_run.x_end,
-            df_run.y_end,
-            width=1,
-            headwidth=4,
-            headlength=6,
-            color="gray",
-            label="Off ball run",
-            zorder=7,
-            ax=ax,
+        artists.append(
+            pitch.arrows(
+                df_run.x_current_frame,
+                df_run.y_current_frame,
+                df_run.x_end,
+                df_run.y_end,
+                width=1,
+                headwidth=4,
+                headlength=6,
+                color="gray",
+                label="Off ball run",
+                zorder=7,
+                ax=ax,
+            )
         )
 
     if len(df_press) > 0:
         # Draw an unfilled red circle for the press
-        ax.scatter(
-            df_press.x_current_frame,
-            df_press.y_current_frame,
-            s=200,
-            edgecolor="red",
-            facecolor="none",
-            label="On ball engagement",
-            zorder=1,
+        artists.append(
+            ax.scatter(
+                df_press.x_current_frame,
+                df_press.y_current_frame,
+                s=200,
+                edgecolor="red",
+                facecolor="none",
+                label="On ball engagement",
+                zorder=1,
+            )
         )
 
     if len(df_passing_option) > 0:
         # Draw an unfilled blue circle for the passing option
-        ax.scatter(
-            df_passing_option.x_current_frame,
-            df_passing_option.y_current_frame,
-            s=200,
-            edgecolor="blue",
-            facecolor="none",
-            label="Passing option",
-            zorder=7,
+        artists.append(
+            ax.scatter(
+                df_passing_option.x_current_frame,
+                df_passing_option.y_current_frame,
+                s=200,
+                edgecolor="blue",
+                facecolor="none",
+                label="Passing option",
+                zorder=7,
+            )
         )
 
     # Add a legend to the plot
-    ax.legend(
-        loc="upper center",
-        fontsize=7,
-        frameon=False,
-        ncol=4,  # Arrange the legend items in a single horizontal row
-        bbox_to_anchor=(0.5, -0.02),  # Position the legend below the plot
+    artists.append(
+        ax.legend(
+            loc="upper center",
+            fontsize=7,
+            frameon=False,
+            ncol=4,  # Arrange the legend items in a single horizontal row
+            bbox_to_anchor=(0.5, -0.02),  # Position the legend below the plot
+        )
     )
 
     return fig, ax
@@ -336,18 +490,28 @@ if len(selected_matches) == 0:
     st.stop()
 
 selected_match_ids = selected_matches["id"].tolist()
-df_events = get_dynamic_data(selected_match_ids)
+events = get_dynamic_data(selected_match_ids)
 with st.expander("Dynamic events", expanded=False):
-    st.dataframe(df_events)
+    # Only send the events to the browser when asked for, the table is large for multiple matches
+    show_events = st.checkbox(
+        "Show dynamic events",
+        value=False,
+        key="show_events",
+        help=f"If checked, the first {EVENTS_PREVIEW_ROWS} dynamic events of the selected matches will be shown.",
+    )
+    if show_events:
+        st.dataframe(events.slice(0, EVENTS_PREVIEW_ROWS), hide_index=True)
 
 # Filter out the passes
-df_player_possessions = df_events[
-    (df_events["event_type"] == "player_possession") & (df_events["end_type"] == "pass")
-]
+df_player_possessions = events.filter(
+    (pc.field("event_type") == "player_possession") & (pc.field("end_type") == "pass")
+).to_pandas()
 
 st.write("Select a pass:")
 selected_event = st.dataframe(
-    df_player_possessions.dropna(
+    df_player_possessions[
+        [column for column in PASS_COLUMNS if column in df_player_possessions.columns]
+    ].dropna(
         axis=1, how="all"
     ),  # Drop all columns that only contain NaN values
     hide_index=True,
@@ -370,11 +534,11 @@ df_event = df_player_possessions[
 ]
 # Extract the associated events based on the event_id and match_id
 # Only keep the events that are still applicable at the moment of the pass
-df_associated_events = df_events[
-    (df_events["associated_player_possession_event_id"] == event_id)
-    & (df_events["match_id"] == match_id)
-    & (df_events["frame_end"] >= selected_event.frame_end.values[0])
-]
+df_associated_events = events.filter(
+    (pc.field("associated_player_possession_event_id") == event_id)
+    & (pc.field("match_id") == match_id)
+    & (pc.field("frame_end") >= selected_event.frame_end.values[0])
+).to_pandas()
 
 
 # Concatenate the two dataframes
@@ -391,27 +555,14 @@ dynamic_events = st.dataframe(
 df_events_to_plot = df_event.iloc[dynamic_events["selection"]["rows"]]
 
 
-# Get the freeze frames for the selected match
-df_freeze_frames = get_freeze_frames(selected_match_ids)
-
 # Get the freeze frame for the selected event. Here I take the end frame of the event
-df_frame = df_freeze_frames[
-    (df_freeze_frames["frame"] == selected_event.frame_end.values[0])
-    & (df_freeze_frames["match_id"] == match_id)
-]
+df_frame = get_frame(match_id, int(selected_event.frame_end.values[0]))
 
 # Plot the frame
 # In SkillCorner the Pitch coordinates are in meters, so we need to know the pitch size
 # Get the meta data for the match
-pitch_length, pitch_width, df_players = get_meta_data(match_id)
-
-# Add the player information to the frame
-df_frame = df_frame.merge(
-    df_players,
-    left_on=["player_id"],
-    right_on=["player_id"],
-    how="left",
-)
+pitch_length, pitch_width = get_pitch_size(match_id)
+visible_area = get_visible_area(match_id, int(selected_event.frame_end.values[0]))
 
 with st.expander("Frame data", expanded=False):
     st.dataframe(df_frame, hide_index=True)
@@ -425,10 +576,10 @@ only_detected = st.checkbox(
 # Plot the pitch
 fig, ax = plot_frame(
     df_frame,
+    visible_area,
     pitch_length,
     pitch_width,
     only_detected=only_detected,
     df_events=df_events_to_plot,
 )
 st.pyplot(fig)
-fig.clear()